@@ -4,11 +4,90 @@ Enhanced API fetcher with parallel request support for faster data retrieval
 import logging
 import asyncio
 import aiohttp
-import json
+import functools
+import orjson
+import sys
 import time
+from typing import Optional
 
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session, created lazily and kept for the lifetime of the process
+# so TCP/TLS connections are pooled across categories and cycles
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+async def get_session():
+    """Return the shared ClientSession, creating it on first use"""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=32,
+            limit_per_host=16,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        _SESSION = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+    return _SESSION
+
+# Minimum seconds between console progress updates
+_PROGRESS_INTERVAL = 0.25
+
+# Shared backoff deadline (time.monotonic) set when the API signals rate
+# limiting; every request waits for it before being sent
+_backoff_until = 0.0
+# Back off once X-RateLimit-Remaining drops to this value or below
+_RATE_LIMIT_LOW_WATER = 2
+
+def _retry_after_seconds(headers, default):
+    """Read Retry-After as a number of seconds, falling back to ``default``"""
+    value = headers.get('Retry-After', '')
+    return int(value) if value.isdigit() else default
+
+def _note_rate_limit(headers, status):
+    """Push the shared backoff deadline out if the response asks us to slow down"""
+    global _backoff_until
+    delay = 0
+    if status == 429:
+        delay = _retry_after_seconds(headers, 2)
+    else:
+        remaining = headers.get('X-RateLimit-Remaining', '')
+        if remaining.isdigit() and int(remaining) <= _RATE_LIMIT_LOW_WATER:
+            delay = _retry_after_seconds(headers, 1)
+    if delay:
+        _backoff_until = max(_backoff_until, time.monotonic() + delay)
+
+# Total match count from the last fetch of each (search_kind, bcat), used
+# only to size the speculative burst; one int per configured search
+_LAST_MATCHES = {}
+
+async def close_session():
+    """Close the shared ClientSession (call once at shutdown)"""
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
+@functools.lru_cache(maxsize=4)
+def _build_headers(csrf_token, cookie_items):
+    """Build the request headers once per token/cookie combination.
+    
+    The returned dict is shared by every request and must not be modified.
+    """
+    return {
+        "authority": "www.machinefinder.com",
+        "accept": "application/json, text/plain, */*",
+        "accept-encoding": "gzip, deflate, br, zstd",
+        "accept-language": "en-US,en;q=0.9",
+        "content-type": "application/json;charset=UTF-8",
+        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+        "x-csrf-token": csrf_token,
+        "x-requested-with": "XMLHttpRequest",
+        "cookie": "; ".join([f"{k}={v}" for k, v in cookie_items])
+    }
+
 async def fetch_via_api_parallel(search_title, search_kind, bcat, max_price, csrf_token, cookies, max_concurrent=5):
     """
     Fetch machines using parallel requests for better performance.
@@ -21,34 +100,26 @@ async def fetch_via_api_parallel(search_title, search_kind, bcat, max_price, csr
         csrf_token: CSRF token for API authentication
         cookies: Session cookies
         max_concurrent: Number of parallel requests (default: 5)
+    
+    Returns:
+        ``(machines, complete)``. ``complete`` is False if any page could not
+        be fetched; ``machines`` then holds only the pages that were, so
+        callers must not treat a missing listing as sold.
     """
     base_url = "https://www.machinefinder.com/ww/en-US/mfinder/results?mw=t&lang_code=en-US"
     
     if not search_kind:
-        logger.warning(f"API: No search_kind provided for {search_title}, skipping.")
-        return []
-    
-    # Headers
-    headers = {
-        "authority": "www.machinefinder.com",
-        "accept": "application/json, text/plain, */*",
-        "accept-encoding": "gzip, deflate, br, zstd",
-        "accept-language": "en-US,en;q=0.9",
-        "content-type": "application/json;charset=UTF-8",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        "x-csrf-token": csrf_token,
-        "x-requested-with": "XMLHttpRequest"
-    }
+        logger.warning("API: No search_kind provided for %s, skipping.", search_title)
+        return [], False
     
-    # Convert cookies dict to string
-    cookie_str = "; ".join([f"{k}={v}" for k, v in cookies.items()])
-    headers["cookie"] = cookie_str
+    headers = _build_headers(csrf_token, tuple(cookies.items()))
     
     all_machines = []
     total_matches = 0
+    complete = True
     
-    # Initial request to get total count
-    initial_payload = {
+    # Search payload shared by every page; only show_more_start differs
+    base_payload = {
         "branding": "co",
         "context": {
             "kind": "mf",
@@ -63,156 +134,196 @@ async def fetch_via_api_parallel(search_title, search_kind, bcat, max_price, csr
         "intro_header": f"Used {search_title} For Sale",
         "locked_criteria": {
             "bcat": [bcat]
-        },
-        "show_more_start": 0
+        }
     }
     
-    try:
-        async with aiohttp.ClientSession() as session:
-            # Get total count
-            async with session.post(base_url, headers=headers, json=initial_payload, timeout=30) as response:
-                if response.status != 200:
-                    logger.error(f"API Error: Status {response.status}")
-                    return []
-                
-                data = await response.json()
-                if 'results' not in data:
-                    logger.error("API Error: 'results' key missing")
-                    return []
-                
-                results = data['results']
-                total_matches = results.get('matches', 0)
-                logger.info(f"API: Found {total_matches} total matches for {search_title}")
-                
-                # Process first page
-                if 'machines' in results:
-                    new_machines = _process_machines(results['machines'], search_title)
-                    all_machines.extend(new_machines)
-            
-            # Calculate remaining offsets
-            offsets = list(range(25, total_matches, 25))
-            
-            if not offsets:
-                return all_machines
-            
-            # Fetch remaining pages in parallel batches
-            for i in range(0, len(offsets), max_concurrent):
-                batch_offsets = offsets[i:i + max_concurrent]
-                
-                # Display progress on same line in console
-                items_fetched = min(25 + (i + len(batch_offsets)) * 25, total_matches)
+    # Serialize the payload once and splice each page's offset onto the end,
+    # so building a request body is just a bytes concatenation
+    body_prefix = orjson.dumps(base_payload)[:-1] + b',"show_more_start":'
+    
+    # Every page goes through the semaphore, so at most max_concurrent
+    # requests are in flight and a new one starts as soon as any finishes
+    sem = asyncio.Semaphore(max_concurrent)
+    pages_done = 0
+    last_progress = 0.0
+    items_shown = 0
+    speculative = {}
+    
+    async def _guarded(offset):
+        nonlocal pages_done, last_progress, items_shown
+        body = body_prefix + str(offset).encode() + b'}'
+        async with sem:
+            result = await fetch_single_page(
+                session, base_url, headers, body, offset, search_title
+            )
+        
+        # Display progress on same line in console, at most every 250 ms
+        # (plus the final update) so flushing stdout never stalls the loop.
+        # Several categories can share the console, so each line is labelled
+        # and the final one ends with a newline to keep it visible
+        pages_done += 1
+        if total_matches:
+            items_fetched = min(pages_done * 25, total_matches)
+            done = items_fetched == total_matches
+            now = time.monotonic()
+            if items_fetched > items_shown and (now - last_progress >= _PROGRESS_INTERVAL or done):
+                last_progress = now
+                items_shown = items_fetched
                 progress = (items_fetched / total_matches) * 100
-                print(f"\rAPI: Progress {int(progress)}% ({items_fetched}/{total_matches})", end='', flush=True)
-                
-                # Create tasks for parallel requests
-                tasks = []
-                for offset in batch_offsets:
-                    payload = initial_payload.copy()
-                    payload['show_more_start'] = offset
-                    tasks.append(fetch_single_page(session, base_url, headers, payload))
-                
-                # Execute parallel requests
-                batch_results = await asyncio.gather(*tasks, return_exceptions=True)
-                
-                # Process results
-                for result in batch_results:
-                    if isinstance(result, Exception):
-                        logger.error(f"API: Request failed: {result}")
-                        continue
-                    
-                    if result and 'machines' in result:
-                        new_machines = _process_machines(result['machines'], search_title)
-                        all_machines.extend(new_machines)
-                
-                # Small delay between batches to be polite
-                if i + max_concurrent < len(offsets):
-                    await asyncio.sleep(0.1)
-            
-            # Print newline after progress is complete
-            print()  # Move to next line after progress completes
+                sys.stdout.write(
+                    f"\rAPI: {search_title}: {int(progress)}% ({items_fetched}/{total_matches})"
+                    + ("\n" if done else "")
+                )
+                sys.stdout.flush()
+        return result
     
+    try:
+        session = await get_session()
+        
+        # Page 0 tells us the total count. Rather than waiting for it, launch
+        # the next few pages speculatively alongside it; the probe is queued
+        # first, so it is the first to get a semaphore slot
+        probe = asyncio.ensure_future(_guarded(0))
+        # The burst is capped at the last known total, so a small category
+        # does not request pages that do not exist; if the total has grown,
+        # the missing pages are fetched after the probe like any other
+        burst_end = 25 * (max_concurrent + 1)
+        last_matches = _LAST_MATCHES.get((search_kind, bcat))
+        if last_matches is not None:
+            burst_end = min(burst_end, last_matches)
+        for offset in range(25, burst_end, 25):
+            speculative[offset] = asyncio.ensure_future(_guarded(offset))
+        
+        results = await probe
+        if results is None:
+            logger.error("API Error: Could not fetch first page for %s", search_title)
+            return [], False
+        
+        total_matches = results.get('matches', 0)
+        _LAST_MATCHES[(search_kind, bcat)] = total_matches
+        logger.info("API: Found %d total matches for %s", total_matches, search_title)
+        
+        all_machines.extend(results['machines'])
+        
+        # Remaining offsets, reusing speculative requests where they apply
+        offsets = range(25, total_matches, 25)
+        tasks = [speculative.pop(offset, None) or _guarded(offset) for offset in offsets]
+        
+        if tasks:
+            # fetch_single_page never raises; a failed page comes back as None
+            page_results = await asyncio.gather(*tasks)
+            
+            # Collect pages in offset order
+            for page in page_results:
+                if page:
+                    all_machines.extend(page['machines'])
+                else:
+                    complete = False
+
     except Exception as e:
-        logger.error(f"API: Critical error fetching {search_title}: {e}")
-        return []
+        logger.error("API: Critical error fetching %s: %s", search_title, e)
+        return [], False
+    finally:
+        # Speculative pages beyond total_matches are not needed
+        for task in speculative.values():
+            task.cancel()
     
     # Client-side filtering for max_price
     if max_price:
         original_count = len(all_machines)
         all_machines = [m for m in all_machines if _parse_price(m['price']) <= max_price]
-        logger.info(f"API: Filtered {original_count} -> {len(all_machines)} machines (Max Price: {max_price})")
+        logger.info("API: Filtered %d -> %d machines (Max Price: %s)", original_count, len(all_machines), max_price)
     
-    return all_machines
+    if not complete:
+        logger.warning("API: Some pages of %s could not be fetched, results are incomplete", search_title)
+    return all_machines, complete
 
-async def fetch_single_page(session, url, headers, payload, max_retries=3):
-    """Fetch a single page of results with retry logic"""
-    offset = payload.get('show_more_start', 0)
+async def fetch_single_page(session, url, headers, body, offset, search_title, max_retries=3):
+    """Fetch a single page of results with retry logic.
     
+    Returns ``{'matches': int, 'machines': [...]}`` with machines already in
+    our internal format, or None if every attempt failed. Mapping happens
+    right after decoding so the raw response object is released immediately.
+    Errors are logged and retried here, never raised to the caller.
+    """
     for attempt in range(max_retries):
+        wait = _backoff_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
         try:
-            async with session.post(url, headers=headers, json=payload, timeout=30) as response:
+            async with session.post(url, headers=headers, data=body) as response:
+                _note_rate_limit(response.headers, response.status)
                 if response.status == 200:
-                    data = await response.json()
-                    return data.get('results', {})
+                    results = orjson.loads(await response.read()).get('results') or {}
+                    return {
+                        'matches': results.get('matches') or 0,
+                        'machines': _process_machines(results.get('machines') or [], search_title)
+                    }
                 else:
-                    logger.warning(f"HTTP {response.status} for offset {offset}, attempt {attempt + 1}/{max_retries}")
-                    if attempt < max_retries - 1:
+                    logger.warning("HTTP %d for offset %d, attempt %d/%d", response.status, offset, attempt + 1, max_retries)
+                    # A 429 is waited out through the backoff deadline instead
+                    if attempt < max_retries - 1 and response.status != 429:
                         await asyncio.sleep(2)  # Wait before retry
         except asyncio.TimeoutError:
-            logger.warning(f"Timeout for offset {offset}, attempt {attempt + 1}/{max_retries}")
+            logger.warning("Timeout for offset %d, attempt %d/%d", offset, attempt + 1, max_retries)
             if attempt < max_retries - 1:
                 await asyncio.sleep(2)
         except Exception as e:
-            logger.warning(f"Error for offset {offset}, attempt {attempt + 1}/{max_retries}: {type(e).__name__}: {str(e)}")
+            logger.warning("Error for offset %d, attempt %d/%d: %s: %s", offset, attempt + 1, max_retries, type(e).__name__, e)
             if attempt < max_retries - 1:
                 await asyncio.sleep(2)
     
     # All retries failed
-    logger.error(f"Failed to fetch page at offset {offset} after {max_retries} attempts")
+    logger.error("Failed to fetch page at offset %d after %d attempts", offset, max_retries)
     return None
 
 def _process_machines(machines_list, search_title):
-    """Convert API machine objects to our internal format"""
+    """Convert API machine objects to our internal format.
+    
+    Entries without an id are skipped up front; every other field falls back
+    to a default or is coerced to a string before string methods are used, so
+    one odd entry can never fail the whole page.
+    """
     processed = []
+    skipped = 0
     for m in machines_list:
-        try:
-            machine_id = str(m.get('id'))
-            
-            # Get URL from API response
-            relative_url = m.get('url', '')
-            if relative_url:
-                link = f"https://www.machinefinder.com{relative_url}"
-            else:
-                link = f"https://www.machinefinder.com/ww/en-US/machines/{machine_id}"
-            
-            # Extract fields using correct API field names
-            title = m.get('label', f"Machine {machine_id}")
-            price = m.get('retail', '')
-            hours = m.get('hrs', '')
-            location = m.get('situ', '').strip()
-            image_url = m.get('gallery', '') or m.get('thumb', '')
-            
-            processed.append({
-                'id': machine_id,
-                'search_title': search_title,
-                'title': title,
-                'price': price,
-                'location': location,
-                'hours': hours,
-                'image_url': image_url,
-                'link': link
-            })
-        except Exception as e:
-            logger.error(f"Error processing machine object: {e}")
+        raw_id = m.get('id') if isinstance(m, dict) else None
+        if raw_id is None:
+            skipped += 1
             continue
+        machine_id = str(raw_id)
+        
+        # Get URL from API response
+        relative_url = m.get('url')
+        if relative_url:
+            link = f"https://www.machinefinder.com{relative_url}"
+        else:
+            link = f"https://www.machinefinder.com/ww/en-US/machines/{machine_id}"
+        
+        # Extract fields using correct API field names
+        processed.append({
+            'id': machine_id,
+            'search_title': search_title,
+            'title': m.get('label', f"Machine {machine_id}"),
+            'price': m.get('retail', ''),
+            'location': str(m.get('situ') or '').strip(),
+            'hours': m.get('hrs', ''),
+            'image_url': m.get('gallery', '') or m.get('thumb', ''),
+            'link': link
+        })
     
+    if skipped:
+        logger.error("Skipped %d machine objects without an id", skipped)
     return processed
 
+# Characters stripped from a price string before float conversion
+_PRICE_TRANS = str.maketrans('', '', '$, ')
+
 def _parse_price(price_str):
     """Parse price string to float for filtering"""
     if not price_str:
         return float('inf')
     try:
-        clean_price = str(price_str).replace('$', '').replace(',', '').strip()
-        return float(clean_price)
-    except:
+        return float(str(price_str).translate(_PRICE_TRANS))
+    except ValueError:
         return float('inf')
@@ -1,6 +1,6 @@
-import json
+import orjson
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 
 DEFAULTS = {
     "cycle_delay_seconds": 3600,
@@ -23,8 +23,8 @@ def load_config() -> Dict[str, Any]:
     if not os.path.exists(CONFIG_PATH):
         raise FileNotFoundError(f"Configuration file not found: {CONFIG_PATH}")
 
-    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-        user_cfg = json.load(f)
+    with open(CONFIG_PATH, "rb") as f:
+        user_cfg = orjson.loads(f.read())
 
     # Merge defaults – user values take precedence
     cfg = {**DEFAULTS, **user_cfg}
@@ -38,3 +38,22 @@ def load_config() -> Dict[str, Any]:
             cfg["telegram_chat_id"] = telegram_cfg["chat_id"]
 
     return cfg
+
+
+def unique_searches(cfg: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Return ``(group_id, search)`` pairs from ``machine_groups`` in config order.
+
+    A search listed more than once (same title, ``search_kind`` and ``bcat``)
+    is only returned the first time, so it is never fetched twice per cycle.
+    """
+    seen = set()
+    searches = []
+    for group_id, items in cfg.get("machine_groups", {}).items():
+        for item in items:
+            search_kind = item.get("search_kind")
+            key = (item.get("title"), search_kind, item.get("bcat", search_kind))
+            if key in seen:
+                continue
+            seen.add(key)
+            searches.append((group_id, item))
+    return searches
@@ -1,101 +1,280 @@
+import atexit
+import json
 import sqlite3
 import os
-from typing import Set
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Iterable, Set
 
-# Path to the SQLite database file
-DB_PATH = os.path.join(os.path.dirname(__file__), "items.db")
+# Absolute path to the SQLite database file, resolved once at import so it
+# does not depend on the working directory
+DB_PATH = os.fspath(Path(__file__).resolve().parent / "items.db")
+
+# Bump whenever init_db changes the schema
+SCHEMA_VERSION = 4
+
+# PRAGMA user_version layout: the low 16 bits hold the schema version and
+# the bits above them are boolean flags
+_SCHEMA_VERSION_MASK = 0xFFFF
+_FLAG_FIRST_RUN_COMPLETE = 1 << 16
+
+# Applied once, when the shared connection is opened
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    # items.category_id is kept consistent by this module, not by SQLite
+    "PRAGMA foreign_keys=OFF",
+)
+
+# Hot-path statements. sqlite3 keeps prepared statements in a per-connection
+# cache keyed by SQL text, so each of these is parsed and planned only once
+_SQL_INSERT_CATEGORY = "INSERT OR IGNORE INTO categories (name) VALUES (?)"
+_SQL_SELECT_CATEGORY = "SELECT id FROM categories WHERE name = ?"
+# Rows already in the right category are left alone, so a steady-state
+# cycle does not rewrite pages or grow the WAL
+_SQL_UPSERT_ITEM = """
+    INSERT INTO items (slug, category_id)
+    VALUES (?, ?)
+    ON CONFLICT(slug) DO UPDATE SET category_id=excluded.category_id
+    WHERE category_id IS NOT excluded.category_id
+"""
+_SQL_ALL_SLUGS = "SELECT slug FROM items"
+_SQL_SLUGS_BY_CATEGORY = "SELECT slug FROM items WHERE category_id = ?"
+_SQL_NEW_SLUGS = "SELECT value FROM json_each(?) WHERE value NOT IN (SELECT slug FROM items)"
+_SQL_COUNT_ITEMS = "SELECT COUNT(*) as cnt FROM items"
+_SQL_DELETE_MISSING = "DELETE FROM items WHERE slug NOT IN (SELECT value FROM json_each(?))"
+_SQL_DELETE_MISSING_BY_CATEGORY = """
+    DELETE FROM items
+    WHERE category_id = ?
+      AND slug NOT IN (SELECT value FROM json_each(?))
+"""
+
+# Single connection reused for the lifetime of the process. It is opened
+# with check_same_thread=False, so every use goes through _LOCK
+_CONN = None
+_LOCK = threading.RLock()
+
+# Category name -> categories.id, so lookups skip a SELECT after first use
+_CATEGORY_IDS = {}
 
 
 def _get_connection():
-    """Create and return a new SQLite connection with Row factory."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Return the shared SQLite connection, opening it on first use.
+
+    The connection runs in autocommit mode (``isolation_level=None``); writes
+    that must be grouped go through :func:`transaction`.
+    """
+    global _CONN
+    with _LOCK:
+        if _CONN is None:
+            conn = sqlite3.connect(
+                DB_PATH,
+                check_same_thread=False,
+                isolation_level=None,
+                cached_statements=256,
+            )
+            conn.row_factory = sqlite3.Row
+            for pragma in _PRAGMAS:
+                conn.execute(pragma)
+            _CONN = conn
+        return _CONN
+
+
+@atexit.register
+def _close_connection():
+    """Close the shared connection when the interpreter exits."""
+    global _CONN
+    with _LOCK:
+        if _CONN is not None:
+            _CONN.close()
+            _CONN = None
+
+
+@contextmanager
+def transaction():
+    """Run the enclosed statements in a single write transaction.
+
+    Nested use joins the outer transaction instead of starting a new one.
+    """
+    with _LOCK:
+        conn = _get_connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            # Ids of categories created in this transaction are gone now
+            _CATEGORY_IDS.clear()
+            raise
+        conn.execute("COMMIT")
+
+
+def _category_id(conn, search_name: str, create: bool = True):
+    """Return the id of a search's category, inserting it if ``create``.
+
+    Returns None for an unknown category when ``create`` is False.
+    """
+    category_id = _CATEGORY_IDS.get(search_name)
+    if category_id is None:
+        if create:
+            conn.execute(_SQL_INSERT_CATEGORY, (search_name,))
+        row = conn.execute(_SQL_SELECT_CATEGORY, (search_name,)).fetchone()
+        if row is None:
+            return None
+        category_id = _CATEGORY_IDS[search_name] = row["id"]
+    return category_id
 
 
 def init_db():
-    """Initialize the database with a minimal table storing only slug and search_name."""
-    with _get_connection() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS items (
-                slug TEXT PRIMARY KEY,
-                search_name TEXT
+    """Initialize the database with a minimal table storing only slug and category.
+
+    Search names are stored once in ``categories`` and referenced by id from
+    ``items``. Databases using the older layout, with a ``search_name`` text
+    column on ``items``, are migrated in place.
+
+    The schema version is kept in ``PRAGMA user_version``, so once a database
+    is up to date this is a single header read.
+    """
+    with _LOCK:
+        conn = _get_connection()
+        user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if user_version & _SCHEMA_VERSION_MASK >= SCHEMA_VERSION:
+            return
+        flags = user_version & ~_SCHEMA_VERSION_MASK
+        with transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS categories (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE
+                )
+                """
             )
-            """
-        )
-        # Create a config table to store settings like first_run_complete
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS config (
-                key TEXT PRIMARY KEY,
-                value TEXT
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(items)")}
+            if "search_name" in columns:
+                conn.execute(
+                    """
+                    INSERT OR IGNORE INTO categories (name)
+                    SELECT DISTINCT search_name FROM items WHERE search_name IS NOT NULL
+                    """
+                )
+                conn.execute("ALTER TABLE items RENAME TO items_old")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS items (
+                    slug TEXT PRIMARY KEY,
+                    category_id INTEGER REFERENCES categories(id)
+                )
+                """
             )
-            """
-        )
-        conn.commit()
+            if "search_name" in columns:
+                conn.execute(
+                    """
+                    INSERT INTO items (slug, category_id)
+                    SELECT o.slug, c.id
+                    FROM items_old o LEFT JOIN categories c ON c.name = o.search_name
+                    """
+                )
+                conn.execute("DROP TABLE items_old")
+            # Covering index: per-search queries read slugs from the index alone
+            conn.execute("DROP INDEX IF EXISTS idx_items_category")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_items_category_slug ON items(category_id, slug)"
+            )
+            # first_run_complete used to live in a config table; it is now a
+            # user_version flag
+            has_config = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'config'"
+            ).fetchone()
+            if has_config:
+                row = conn.execute(
+                    "SELECT value FROM config WHERE key = 'first_run_complete'"
+                ).fetchone()
+                if row is not None and row["value"] == "true":
+                    flags |= _FLAG_FIRST_RUN_COMPLETE
+                conn.execute("DROP TABLE config")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION | flags}")
+        # The migration rebuilt tables and indexes, so refresh the statistics
+        analyze()
 
 
 def is_first_run() -> bool:
-    """Check if this is the first run (no items in database)."""
-    with _get_connection() as conn:
-        row = conn.execute(
-            "SELECT value FROM config WHERE key = 'first_run_complete'"
-        ).fetchone()
-        # If the flag doesn't exist or is not 'true', it's the first run
-        return row is None or row["value"] != "true"
+    """Check if this is the first run (first-run flag not set yet)."""
+    with _LOCK:
+        conn = _get_connection()
+        user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        return not user_version & _FLAG_FIRST_RUN_COMPLETE
 
 
 def mark_first_run_complete():
     """Mark that the first run is complete."""
-    with _get_connection() as conn:
+    with transaction() as conn:
+        user_version = conn.execute("PRAGMA user_version").fetchone()[0]
         conn.execute(
-            """
-            INSERT INTO config (key, value)
-            VALUES ('first_run_complete', 'true')
-            ON CONFLICT(key) DO UPDATE SET value='true'
-            """
+            f"PRAGMA user_version = {user_version | _FLAG_FIRST_RUN_COMPLETE}"
         )
-        conn.commit()
 
 
 def upsert_item(slug: str, search_name: str):
     """Insert a new record or update the existing one based on slug.
 
-    Only the slug and the search_name are stored to save space.
+    Only the slug and the search's category id are stored to save space.
     """
-    with _get_connection() as conn:
-        conn.execute(
-            """
-            INSERT INTO items (slug, search_name)
-            VALUES (?, ?)
-            ON CONFLICT(slug) DO UPDATE SET search_name=excluded.search_name
-            """,
-            (slug, search_name),
+    upsert_items([slug], search_name)
+
+
+def upsert_items(slugs: Iterable[str], search_name: str):
+    """Insert or update many slugs for one search in a single statement batch."""
+    with transaction() as conn:
+        category_id = _category_id(conn, search_name)
+        conn.executemany(
+            _SQL_UPSERT_ITEM, [(slug, category_id) for slug in slugs]
         )
-        conn.commit()
 
 
 def get_all_slugs() -> Set[str]:
     """Return a set of all slugs currently stored in the database."""
-    with _get_connection() as conn:
-        rows = conn.execute("SELECT slug FROM items").fetchall()
+    with _LOCK:
+        conn = _get_connection()
+        rows = conn.execute(_SQL_ALL_SLUGS).fetchall()
         return {row["slug"] for row in rows}
 
 
 def get_slugs_by_search(search_name: str) -> Set[str]:
     """Return slugs for items belonging to a specific search (category)."""
-    with _get_connection() as conn:
-        rows = conn.execute(
-            "SELECT slug FROM items WHERE search_name = ?", (search_name,)
-        ).fetchall()
+    with _LOCK:
+        conn = _get_connection()
+        category_id = _category_id(conn, search_name, create=False)
+        if category_id is None:
+            return set()
+        rows = conn.execute(_SQL_SLUGS_BY_CATEGORY, (category_id,)).fetchall()
         return {row["slug"] for row in rows}
 
 
+def get_new_slugs(slugs: Iterable[str]) -> Set[str]:
+    """Return the given slugs that are not stored in the database yet.
+
+    The comparison runs inside SQLite, so existing slugs are never loaded
+    into Python.
+    """
+    with _LOCK:
+        conn = _get_connection()
+        rows = conn.execute(_SQL_NEW_SLUGS, (json.dumps(list(slugs)),)).fetchall()
+        return {row["value"] for row in rows}
+
+
 def get_total_count() -> int:
     """Return total number of items stored in the DB."""
-    with _get_connection() as conn:
-        row = conn.execute("SELECT COUNT(*) as cnt FROM items").fetchone()
+    with _LOCK:
+        conn = _get_connection()
+        row = conn.execute(_SQL_COUNT_ITEMS).fetchone()
         return row["cnt"] if row else 0
 
 
@@ -103,12 +282,8 @@ def delete_missing(slugs: Set[str]):
     """Delete rows whose slug is not present in the supplied set."""
     if not slugs:
         return
-    placeholders = ",".join(["?"] * len(slugs))
-    with _get_connection() as conn:
-        conn.execute(
-            f"DELETE FROM items WHERE slug NOT IN ({placeholders})", tuple(slugs)
-        )
-        conn.commit()
+    with transaction() as conn:
+        conn.execute(_SQL_DELETE_MISSING, (json.dumps(list(slugs)),))
 
 
 def delete_missing_by_search(search_name: str, current_slugs: Set[str]) -> int:
@@ -116,24 +291,29 @@ def delete_missing_by_search(search_name: str, current_slugs: Set[str]) -> int:
     
     Returns the number of deleted items.
     """
-    with _get_connection() as conn:
-        # Get existing slugs for this search
-        existing = conn.execute(
-            "SELECT slug FROM items WHERE search_name = ?", (search_name,)
-        ).fetchall()
-        existing_slugs = {row["slug"] for row in existing}
-        
-        # Find slugs to delete (in DB but not in current fetch)
-        to_delete = existing_slugs - current_slugs
-        
-        if not to_delete:
+    # The current set is bound as one JSON array so the statement stays the
+    # same size regardless of how many slugs were fetched
+    with transaction() as conn:
+        category_id = _category_id(conn, search_name, create=False)
+        if category_id is None:
             return 0
-        
-        # Delete them
-        placeholders = ",".join(["?"] * len(to_delete))
-        conn.execute(
-            f"DELETE FROM items WHERE slug IN ({placeholders})",
-            tuple(to_delete)
+        cur = conn.execute(
+            _SQL_DELETE_MISSING_BY_CATEGORY,
+            (category_id, json.dumps(list(current_slugs))),
         )
-        conn.commit()
-        return len(to_delete)
+        return cur.rowcount
+
+
+def analyze():
+    """Refresh the query planner statistics after a bulk load."""
+    with _LOCK:
+        _get_connection().execute("ANALYZE")
+
+
+def optimize():
+    """Let SQLite refresh planner statistics only where they are out of date.
+
+    Cheap enough to run after every cycle, unlike a full :func:`analyze`.
+    """
+    with _LOCK:
+        _get_connection().execute("PRAGMA optimize")
@@ -3,14 +3,18 @@ Final script to fetch ALL categories using parallel requests (5 concurrent)
 Shows timing for each category
 """
 import asyncio
-import json
 import logging
-import re
-import requests
+import orjson
 import os
+import statistics
+import tempfile
 import time
+from dataclasses import asdict, dataclass
 from datetime import datetime
-from api_mode_fetch_parallel import fetch_via_api_parallel
+from typing import Optional
+from api_mode_fetch_parallel import fetch_via_api_parallel, close_session
+from config_loader import load_config, unique_searches
+from fetch_common import get_csrf_and_cookies, N_CATEGORIES_CONCURRENT
 
 # Configure logging
 logging.basicConfig(
@@ -19,27 +23,61 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def get_csrf_and_cookies():
-    url = "https://www.machinefinder.com/"
-    response = requests.get(url)
-    response.raise_for_status()
-    
-    # Extract CSRF token from category page
-    cat_url = "https://www.machinefinder.com/ww/en-US/categories/used-excavators"
-    cat_resp = requests.get(cat_url, cookies=response.cookies)
+@dataclass(slots=True)
+class CatStat:
+    """Outcome of fetching one category"""
+    title: str
+    search_kind: str
+    count: int
+    time_seconds: float
+    speed_items_per_sec: float = 0.0
+    file: Optional[str] = None
+    status: str = 'SUCCESS'
+    error: Optional[str] = None
+
+# Process umask, read once at import (changing it later is not thread-safe)
+# so files written through a temporary file get the usual permissions
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _save_json(filepath, data):
+    """Write ``data`` as indented JSON, atomically and only if it changed.
     
-    match = re.search(r'<meta name="csrf-token" (?:enhanced="true" )?content="([^"]+)"', cat_resp.text)
-    if match:
-        token = match.group(1)
-        return token, cat_resp.cookies
-    else:
-        raise ValueError("Could not find CSRF token on category page")
+    The file is written to a temporary name in the same directory and then
+    moved into place, so readers never see a half-written file. Returns False
+    when the existing file already holds identical output.
+    """
+    payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    try:
+        with open(filepath, 'rb') as f:
+            if f.read() == payload:
+                return False
+    except FileNotFoundError:
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        # mkstemp creates the file owner-only; match a normally created file
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+def _previous_counts(summary_path):
+    """Machine count per category title from the last run's summary, if any"""
+    try:
+        with open(summary_path, 'rb') as f:
+            summary = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    return {stat['title']: stat['count'] for stat in summary.get('categories', [])}
 
 async def main():
     # Load config
-    config_path = 'api_config.json'
-    with open(config_path, 'r') as f:
-        config = json.load(f)
+    config = load_config()
         
     try:
         logger.info("="*80)
@@ -58,31 +96,21 @@ async def main():
 
     # Track statistics
     total_start = time.time()
-    total_categories = 0
-    total_machines = 0
-    category_stats = []
-
-    # Iterate over all groups and all items
-    machine_groups = config.get('machine_groups', {})
-    for group_id, items in machine_groups.items():
-        logger.info(f"{'─'*80}")
-        logger.info(f"📁 GROUP {group_id}")
-        logger.info(f"{'─'*80}")
+    
+    async def run_category(group_id, item, sem):
+        title = item.get('title')
+        search_kind = item.get('search_kind')
+        bcat = item.get('bcat', search_kind)
         
-        for item in items:
-            title = item.get('title')
-            search_kind = item.get('search_kind')
-            bcat = item.get('bcat', search_kind)
-            total_categories += 1
-            
-            logger.info(f"\n🔍 Fetching: {title}")
+        async with sem:
+            logger.info(f"\n🔍 Fetching: {title} (group {group_id})")
             
             # Time this category
             cat_start = time.time()
             
             try:
                 # Call the parallel fetcher with 5 concurrent requests
-                machines = await fetch_via_api_parallel(
+                machines, complete = await fetch_via_api_parallel(
                     search_title=title,
                     search_kind=search_kind,
                     bcat=bcat,
@@ -94,44 +122,75 @@ async def main():
                 
                 cat_elapsed = time.time() - cat_start
                 
-                # Save to JSON file
-                filename = f"{search_kind}.json"
+                # Save to JSON file off the event loop so encoding and disk
+                # I/O do not hold up the other categories' requests. Files are
+                # named by bcat: several categories share a search_kind, and
+                # concurrent categories must never write the same file
+                filename = f"{bcat}.json"
                 filepath = os.path.join(output_dir, filename)
                 
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    json.dump(machines, f, indent=2, ensure_ascii=False)
+                written = await asyncio.to_thread(_save_json, filepath, machines)
                 
                 # Update statistics
                 machine_count = len(machines)
-                total_machines += machine_count
                 
                 # Calculate speed
                 speed = machine_count / cat_elapsed if cat_elapsed > 0 else 0
                 
-                category_stats.append({
-                    'title': title,
-                    'search_kind': search_kind,
-                    'count': machine_count,
-                    'time_seconds': round(cat_elapsed, 2),
-                    'speed_items_per_sec': round(speed, 1),
-                    'file': filename,
-                    'status': 'SUCCESS'
-                })
-                
-                logger.info(f"✓ Saved {machine_count} machines to {filename}")
+                if written:
+                    logger.info(f"✓ Saved {machine_count} machines to {filename}")
+                else:
+                    logger.info(f"✓ {filename} unchanged ({machine_count} machines)")
                 logger.info(f"  ⏱️  Time: {cat_elapsed:.2f}s | Speed: {speed:.1f} items/s")
+                if not complete:
+                    logger.warning(f"⚠ {title}: some pages failed, {filename} is incomplete")
+                
+                return CatStat(
+                    title=title,
+                    search_kind=search_kind,
+                    count=machine_count,
+                    time_seconds=round(cat_elapsed, 2),
+                    speed_items_per_sec=round(speed, 1),
+                    file=filename,
+                    status='SUCCESS' if complete else 'PARTIAL'
+                )
                 
             except Exception as e:
                 cat_elapsed = time.time() - cat_start
                 logger.error(f"✗ Failed to fetch {title}: {e}")
-                category_stats.append({
-                    'title': title,
-                    'search_kind': search_kind,
-                    'count': 0,
-                    'time_seconds': round(cat_elapsed, 2),
-                    'status': 'FAILED',
-                    'error': str(e)
-                })
+                return CatStat(
+                    title=title,
+                    search_kind=search_kind,
+                    count=0,
+                    time_seconds=round(cat_elapsed, 2),
+                    status='FAILED',
+                    error=str(e)
+                )
+
+    # Run categories concurrently; each one already issues 5 parallel page
+    # requests, so only a few categories are allowed in flight at once
+    sem = asyncio.Semaphore(N_CATEGORIES_CONCURRENT)
+    categories = unique_searches(config)
+    
+    # Start the largest categories first (by last run's count) so a big one
+    # is not left running alone at the end. Categories without a previous
+    # count are assumed to be large
+    previous_counts = _previous_counts(os.path.join(output_dir, '_summary.json'))
+    order = sorted(
+        range(len(categories)),
+        key=lambda i: -previous_counts.get(categories[i][1].get('title'), float('inf'))
+    )
+    results = await asyncio.gather(*(run_category(*categories[i], sem) for i in order))
+    
+    # Report in config order
+    category_stats = [None] * len(categories)
+    for i, stat in zip(order, results):
+        category_stats[i] = stat
+    total_categories = len(category_stats)
+    total_machines = sum(stat.count for stat in category_stats)
+    # Slowest-category tail; quantiles() needs at least two data points
+    cat_times = [stat.time_seconds for stat in category_stats]
+    p95_time = statistics.quantiles(cat_times, n=20, method='inclusive')[-1] if len(cat_times) > 1 else sum(cat_times)
 
     total_elapsed = time.time() - total_start
     
@@ -141,16 +200,19 @@ async def main():
     logger.info(f"{'═'*80}")
     
     for stat in category_stats:
-        if stat['status'] == 'SUCCESS':
-            logger.info(f"✓ {stat['title']:30} {stat['count']:5} machines | {stat['time_seconds']:6.2f}s | {stat['speed_items_per_sec']:6.1f} items/s")
+        if stat.status == 'SUCCESS':
+            logger.info(f"✓ {stat.title:30} {stat.count:5} machines | {stat.time_seconds:6.2f}s | {stat.speed_items_per_sec:6.1f} items/s")
+        elif stat.status == 'PARTIAL':
+            logger.info(f"⚠ {stat.title:30} {stat.count:5} machines | {stat.time_seconds:6.2f}s | PARTIAL")
         else:
-            logger.info(f"✗ {stat['title']:30} FAILED")
+            logger.info(f"✗ {stat.title:30} FAILED")
     
     logger.info(f"\n{'─'*80}")
     logger.info(f"Total Categories:    {total_categories}")
     logger.info(f"Total Machines:      {total_machines:,}")
     logger.info(f"Total Time:          {total_elapsed:.2f}s ({total_elapsed/60:.1f} minutes)")
     logger.info(f"Overall Speed:       {total_machines/total_elapsed:.1f} items/s")
+    logger.info(f"p95 Category Time:   {p95_time:.2f}s")
     logger.info(f"{'═'*80}\n")
     
     # Save summary
@@ -160,13 +222,21 @@ async def main():
         'total_machines': total_machines,
         'total_time_seconds': round(total_elapsed, 2),
         'overall_speed': round(total_machines/total_elapsed, 2),
-        'categories': category_stats
+        'p95_category_time_seconds': round(p95_time, 2),
+        'categories': [asdict(stat) for stat in category_stats]
     }
     
-    with open(os.path.join(output_dir, '_summary.json'), 'w', encoding='utf-8') as f:
-        json.dump(summary, f, indent=2, ensure_ascii=False)
+    _save_json(os.path.join(output_dir, '_summary.json'), summary)
     
     logger.info(f"✓ Summary saved to: {output_dir}/_summary.json")
+    
+    await close_session()
 
 if __name__ == "__main__":
+    # uvloop is a faster drop-in event loop; it is not available on Windows
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())
@@ -0,0 +1,35 @@
+"""
+Site session helpers shared by fetch_all_parallel and periodic_fetch
+"""
+import re
+import requests
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+
+_CSRF_RE = re.compile(rb'<meta name="csrf-token" (?:enhanced="true" )?content="([^"]+)"')
+
+# Number of categories fetched at the same time
+N_CATEGORIES_CONCURRENT = 3
+
+def get_csrf_and_cookies():
+    # One session for both requests: the second reuses the first's
+    # keep-alive connection and cookie jar
+    with requests.Session() as session:
+        session.headers.update({"User-Agent": USER_AGENT})
+        
+        url = "https://www.machinefinder.com/"
+        response = session.get(url)
+        response.raise_for_status()
+        
+        # Extract CSRF token from category page
+        cat_url = "https://www.machinefinder.com/ww/en-US/categories/used-excavators"
+        cat_resp = session.get(cat_url)
+        
+        # Search the raw bytes; decoding the whole page just to find one
+        # meta tag is wasted work
+        match = _CSRF_RE.search(cat_resp.content)
+        if match:
+            token = match.group(1).decode()
+            return token, session.cookies
+        else:
+            raise ValueError("Could not find CSRF token on category page")
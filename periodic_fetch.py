@@ -1,17 +1,20 @@
 import asyncio
+import atexit
 import logging
 import os
+import queue
 import time
-from logging.handlers import RotatingFileHandler
-from typing import List, Dict, Set
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import List, Dict, Optional, Set
 
-from db_helper import init_db, upsert_item, get_all_slugs, delete_missing, get_total_count, is_first_run, mark_first_run_complete
-from config_loader import load_config
-from api_mode_fetch_parallel import fetch_via_api_parallel
+from db_helper import init_db, analyze, optimize, transaction, upsert_items, get_new_slugs, get_slugs_by_search, delete_missing_by_search, is_first_run, mark_first_run_complete
+from config_loader import load_config, unique_searches
+from api_mode_fetch_parallel import fetch_via_api_parallel, close_session
+from fetch_common import get_csrf_and_cookies, N_CATEGORIES_CONCURRENT
 from telegram_notifier import TelegramNotifier
 
 # ---------------------------------------------------------------------------
-# Logging setup (two rotating loggers: normal and timing)
+# Logging setup (two rotating loggers: normal and timing, written off-thread)
 # ---------------------------------------------------------------------------
 def _setup_loggers(log_dir: str, max_mb: int) -> None:
     os.makedirs(log_dir, exist_ok=True)
@@ -29,15 +32,26 @@ def _setup_loggers(log_dir: str, max_mb: int) -> None:
     timing_logger = logging.getLogger("timing")
     normal_logger.setLevel(logging.INFO)
     timing_logger.setLevel(logging.INFO)
-    normal_logger.addHandler(normal_handler)
-    timing_logger.addHandler(timing_handler)
+    
+    # The loggers only enqueue records; a background thread per file does the
+    # formatting and the blocking writes, so logging never stalls the loop.
+    # They do not propagate, so no root handler writes on the loop either
+    for logger, handler in ((normal_logger, normal_handler), (timing_logger, timing_handler)):
+        records = queue.SimpleQueue()
+        logger.addHandler(QueueHandler(records))
+        logger.propagate = False
+        listener = QueueListener(records, handler)
+        listener.start()
+        # Flush whatever is still queued on exit
+        atexit.register(listener.stop)
 
 # ---------------------------------------------------------------------------
 # Helper to extract the slug (unique part) from a full URL
 # ---------------------------------------------------------------------------
 def _extract_slug(url: str) -> str:
     # URL format: https://www.machinefinder.com/ww/en-US/machines/<slug>
-    return url.rstrip("/").split("/")[-1]
+    # rpartition scans from the end once instead of splitting every segment
+    return url.rstrip("/").rpartition("/")[2]
 
 # ---------------------------------------------------------------------------
 # Core cycle implementation
@@ -45,8 +59,28 @@ def _extract_slug(url: str) -> str:
 # Global cycle counter
 _cycle_number = 0
 
+# Notifications still being sent for an earlier cycle. A reference is kept
+# so the task is not garbage-collected and can be awaited at shutdown
+_notify_task: Optional[asyncio.Task] = None
+
+async def _send_notifications(notifier: TelegramNotifier, grouped: Dict[str, List[Dict]]) -> None:
+    normal_logger = logging.getLogger("normal")
+    for search_name, items in grouped.items():
+        await notifier.send_new_items_notification(search_name, items)
+    normal_logger.info(f"Sent notifications for {sum(map(len, grouped.values()))} new items")
+
+async def wait_for_notifications() -> None:
+    """Wait until notifications from the previous cycle have been sent."""
+    global _notify_task
+    if _notify_task is not None:
+        try:
+            await _notify_task
+        except Exception as e:
+            logging.getLogger("normal").error(f"Sending notifications failed: {e}")
+        _notify_task = None
+
 async def run_cycle(config: Dict) -> None:
-    global _cycle_number
+    global _cycle_number, _notify_task
     _cycle_number += 1
     
     normal_logger = logging.getLogger("normal")
@@ -67,8 +101,6 @@ async def run_cycle(config: Dict) -> None:
     if first_run:
         normal_logger.info("FIRST RUN DETECTED - Will save all items without notifications")
     
-    stored_slugs = get_all_slugs()
-    fetched_slugs: Set[str] = set()
     new_items: List[Dict] = []
     new_items_slugs: Set[str] = set()  # Track new items to avoid duplicates
 
@@ -79,26 +111,18 @@ async def run_cycle(config: Dict) -> None:
     )
 
     # CSRF & cookies – reuse the same logic as fetch_all_parallel
-    from fetch_all_parallel import get_csrf_and_cookies
     csrf_token, cookies = get_csrf_and_cookies()
 
-    machine_groups = config.get("machine_groups", {})
-    for group_id, items in machine_groups.items():
-        for item_cfg in items:
-            # --- per-search timing & stats ---
-            search_start = time.time()
-            title = item_cfg.get("title")
-            search_kind = item_cfg.get("search_kind")
-            bcat = item_cfg.get("bcat", search_kind)
+    # Fetch a few searches at a time; each one already issues 5 parallel
+    # page requests, so only N_CATEGORIES_CONCURRENT run at once
+    sem = asyncio.Semaphore(N_CATEGORIES_CONCURRENT)
+    
+    async def _fetch(group_id: str, title: str, search_kind: str, bcat: str):
+        async with sem:
             normal_logger.info(f"Fetching {title} (group {group_id})")
-            
-            # Get existing items for this search BEFORE fetching
-            from db_helper import get_slugs_by_search, delete_missing_by_search
-            existing_slugs_for_search = get_slugs_by_search(title)
-            items_before = len(existing_slugs_for_search)
-            
+            fetch_start = time.time()
             try:
-                machines = await fetch_via_api_parallel(
+                machines, complete = await fetch_via_api_parallel(
                     search_title=title,
                     search_kind=search_kind,
                     bcat=bcat,
@@ -109,10 +133,38 @@ async def run_cycle(config: Dict) -> None:
                 )
             except Exception as e:
                 normal_logger.error(f"Failed to fetch {title}: {e}")
+                machines, complete = None, False
+            return machines, complete, time.time() - fetch_start
+    
+    searches = []
+    for group_id, item_cfg in unique_searches(config):
+        title = item_cfg.get("title")
+        search_kind = item_cfg.get("search_kind")
+        bcat = item_cfg.get("bcat", search_kind)
+        searches.append((title, _fetch(group_id, title, search_kind, bcat)))
+    
+    # Every fetch finishes before the DB is touched, so the write transaction
+    # below is never held across a network await
+    fetched = await asyncio.gather(*(fetch for _, fetch in searches))
+    
+    # Results are written to the DB one search at a time, in config order.
+    # One write transaction for the whole cycle instead of one per search
+    # Stats per processed search, logged once stale rows have been deleted
+    search_stats: List[Dict] = []
+    with transaction():
+        for (title, _), (machines, complete, fetch_elapsed) in zip(searches, fetched):
+            if machines is None:
                 continue
-
+            
+            # --- per-search timing & stats ---
+            process_start = time.time()
+            
+            # Items stored for this search before this cycle's results
+            existing_slugs_for_search = get_slugs_by_search(title)
+            items_before = len(existing_slugs_for_search)
+            
             # Process fetched machines
-            current_slugs_for_search = set()
+            records: Dict[str, Dict] = {}
             new_items_count = 0
             
             for m in machines:
@@ -120,13 +172,10 @@ async def run_cycle(config: Dict) -> None:
                 if not link:
                     continue
                 slug = _extract_slug(link)
-                if not slug:
+                if not slug or slug in records:
                     continue
                 
-                current_slugs_for_search.add(slug)
-                fetched_slugs.add(slug)
-                
-                record = {
+                records[slug] = {
                     "slug": slug,
                     "title": m.get("title"),
                     "price": m.get("price"),
@@ -136,30 +185,59 @@ async def run_cycle(config: Dict) -> None:
                     "search_name": title,
                     "image_url": m.get("image_url"),
                 }
-                upsert_item(slug, title)
-                
-                # Only add to new_items if not seen before (in DB or this cycle)
-                if slug not in stored_slugs and slug not in new_items_slugs:
-                    new_items.append(record)
-                    new_items_slugs.add(slug)
-                    stored_slugs.add(slug)  # Update to avoid duplicates in next search
-                    new_items_count += 1
             
-            # Delete stale items for this search
-            deleted_count = delete_missing_by_search(title, current_slugs_for_search)
+            current_slugs_for_search = set(records)
             
-            # Get count after cleanup
-            items_after = len(current_slugs_for_search)
+            # Steady state: the search returned exactly what is stored for
+            # it, so there is nothing new to insert or stale to delete
+            changed = current_slugs_for_search != existing_slugs_for_search
+            if changed:
+                # Only add to new_items if not in the DB yet. Earlier searches
+                # this cycle are already upserted, so they count as stored
+                new_slugs = get_new_slugs(current_slugs_for_search)
+                for slug, record in records.items():
+                    if slug in new_slugs and slug not in new_items_slugs:
+                        new_items.append(record)
+                        new_items_slugs.add(slug)
+                        new_items_count += 1
+                
+                # Save all fetched slugs for this search in one batch
+                upsert_items(current_slugs_for_search, title)
             
             # End of processing this search
-            search_elapsed = time.time() - search_start
-            fetched_count = len(machines)
-            
-            normal_logger.info(
-                f"Search '{title}' completed: time_taken={search_elapsed:.2f}s, "
-                f"fetched={fetched_count}, items_before={items_before}, "
-                f"new={new_items_count}, deleted={deleted_count}, items_after={items_after}"
-            )
+            search_stats.append({
+                "title": title,
+                # A search with failed pages is missing listings that
+                # still exist, so its stale rows are left alone
+                "slugs": current_slugs_for_search if changed and complete else None,
+                "time_taken": fetch_elapsed + time.time() - process_start,
+                "fetched": len(machines),
+                "items_before": items_before,
+                "new": new_items_count,
+                "deleted": 0,
+                "items_after": len(current_slugs_for_search),
+            })
+        
+        # Stale rows are deleted only after every search has been checked
+        # for new slugs. An item that moved from an earlier search to a
+        # later one is still stored when the later search looks at it, so
+        # it is not reported as new
+        for stats in search_stats:
+            if stats["slugs"] is not None:
+                stats["deleted"] = delete_missing_by_search(stats["title"], stats["slugs"])
+    
+    for stats in search_stats:
+        normal_logger.info(
+            f"Search '{stats['title']}' completed: time_taken={stats['time_taken']:.2f}s, "
+            f"fetched={stats['fetched']}, items_before={stats['items_before']}, "
+            f"new={stats['new']}, deleted={stats['deleted']}, items_after={stats['items_after']}"
+        )
+    # A full ANALYZE only after the first run's bulk load; later cycles
+    # change few rows, and PRAGMA optimize re-analyzes only if needed
+    if first_run:
+        analyze()
+    else:
+        optimize()
 
     # Send notifications for newly discovered items (SKIP ON FIRST RUN)
     if first_run:
@@ -171,9 +249,12 @@ async def run_cycle(config: Dict) -> None:
         grouped: Dict[str, List[Dict]] = {}
         for itm in new_items:
             grouped.setdefault(itm["search_name"], []).append(itm)
-        for search_name, items in grouped.items():
-            await notifier.send_new_items_notification(search_name, items)
-        normal_logger.info(f"Sent notifications for {len(new_items)} new items")
+        # Telegram pacing makes sending slow, so it runs in the background
+        # and the cycle finishes without waiting. Messages from the previous
+        # cycle go out first, keeping them in order and under flood control
+        await wait_for_notifications()
+        _notify_task = asyncio.create_task(_send_notifications(notifier, grouped))
+        normal_logger.info(f"Queued notifications for {len(new_items)} new items")
     else:
         normal_logger.info("No new items found this cycle")
 
@@ -190,9 +271,19 @@ async def main() -> None:
     cfg = load_config()
     _setup_loggers(cfg.get("log_dir", "logs"), cfg.get("max_log_size_mb", 50))
     delay = cfg.get("cycle_delay_seconds", 3600)
-    while True:
-        await run_cycle(cfg)
-        await asyncio.sleep(delay)
+    try:
+        while True:
+            await run_cycle(cfg)
+            await asyncio.sleep(delay)
+    finally:
+        await close_session()
+        await wait_for_notifications()
 
 if __name__ == "__main__":
+    # uvloop is a faster drop-in event loop; it is not available on Windows
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())
@@ -8,6 +8,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Minimum seconds between the start of two consecutive messages
+MESSAGE_INTERVAL = 3
+
 
 class TelegramNotifier:
     def __init__(self, bot_token: str, chat_id: str):
@@ -20,37 +23,52 @@ class TelegramNotifier:
         if not machines:
             return
         
+        # Images are downloaded in a worker thread, one machine ahead, so the
+        # next download overlaps the current send and flood-control delay
+        next_image = self._start_image_download(machines[0])
+        loop = asyncio.get_running_loop()
         try:
-            for machine in machines:
-                await self._send_machine_notification(search_title, machine)
-                # Delay between messages to avoid Telegram flood control
-                await asyncio.sleep(3)
+            for i, machine in enumerate(machines):
+                image_data = await next_image if next_image else None
+                next_image = None
+                if i + 1 < len(machines):
+                    next_image = self._start_image_download(machines[i + 1])
+                # Messages start at least MESSAGE_INTERVAL apart to avoid
+                # Telegram flood control; the deadline is taken when the send
+                # starts, so time spent sending counts towards the gap
+                send_at = loop.time() + MESSAGE_INTERVAL
+                await self._send_machine_notification(search_title, machine, image_data)
+                await asyncio.sleep(max(0.0, send_at - loop.time()))
         except TelegramError as e:
             logger.error(f"Error sending Telegram notification: {e}")
+        finally:
+            if next_image:
+                next_image.cancel()
+    
+    def _start_image_download(self, machine: Dict):
+        """Start downloading a machine's image off the event loop, if it has one"""
+        image_url = machine.get('image_url', '')
+        if not image_url:
+            return None
+        return asyncio.ensure_future(asyncio.to_thread(self._download_image, image_url))
     
-    async def _send_machine_notification(self, search_title: str, machine: Dict):
-        """Send notification for a single machine with image"""
+    async def _send_machine_notification(self, search_title: str, machine: Dict, image_data: BytesIO = None):
+        """Send notification for a single machine, with its image if downloaded"""
         # Format message
         message = self._format_message(search_title, machine)
         
         # Try to send with image
-        image_url = machine.get('image_url', '')
-        
-        if image_url:
+        if image_data:
             try:
-                # Download image
-                image_data = self._download_image(image_url)
-                
-                if image_data:
-                    # Send photo with caption
-                    await self.bot.send_photo(
-                        chat_id=self.chat_id,
-                        photo=image_data,
-                        caption=message,
-                        parse_mode='HTML'
-                    )
-                    logger.info(f"Sent notification with image for: {machine['title']}")
-                    return
+                # Send photo with caption
+                await self.bot.send_photo(
+                    chat_id=self.chat_id,
+                    photo=image_data,
+                    caption=message,
+                    parse_mode='HTML'
+                )
+                logger.info(f"Sent notification with image for: {machine['title']}")
+                return
             except Exception as e:
                 logger.warning(f"Failed to send image, sending text only: {e}")
         